@@ -3,15 +3,22 @@ import sys
 import struct
 import re
 import os
-from itertools import chain
+import time
+import shutil
+import argparse
+from itertools import chain, repeat
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+from hashlib import sha256
 import warnings
 import tarfile
 
 import sh
 from tqdm import tqdm
 
+import pydebhelper
 from pydebhelper import *
-from getLatestVersionAndURLWithGitHubAPI import getTargets
+from getLatestVersionAndURLWithGitHubAPI import getTargets, ReleasesPoller
 
 
 
@@ -103,20 +110,25 @@ def removeUnneededSources(unpackedDir):
 		f.unlink()
 
 
-def ripGraalPackage(unpackedDir, packagesDir, version, maintainer, builtDir):
-	mainPackageName = "graalvm"
-	systemPrefix = "usr/lib/jvm/graalvm-ce-amd64"
+mainPackageName = "graalvm"
+
+
+def ripGraalPackage(unpackedDir, packagesDir, version, maintainer, builtDir, arch="amd64", only=None):
+	"""`only` is a collection of keys of `config`; if given, only their packages are built and the main package is not"""
+	systemPrefix = "usr/lib/jvm/graalvm-ce-" + arch
 
 	removeUnneededSources(unpackedDir)
 
 	results = []
 
 	for pkgPostfix, pkgCfg in config.items():
+		if only is not None and pkgPostfix not in only:
+			continue
 		pkgCfg = type(pkgCfg)(pkgCfg)
 		rip = pkgCfg["rip"]
 		del pkgCfg["rip"]
 
-		with Package(mainPackageName + "-" + pkgPostfix, packagesDir, version=version, section="java", maintainer=maintainer, builtDir=builtDir, **pkgCfg) as pkg:
+		with Package(mainPackageName + "-" + pkgPostfix, packagesDir, arch=arch, version=version, section="java", maintainer=maintainer, builtDir=builtDir, **pkgCfg) as pkg:
 			if "other" in rip:
 				for el in rip["other"]:
 					pkg.rip(unpackedDir / el, systemPrefix + "/" + el)
@@ -138,7 +150,10 @@ def ripGraalPackage(unpackedDir, packagesDir, version, maintainer, builtDir):
 						warnings.warn(str(bUnp) + " doesn't exist")
 			results.append(pkg)
 
-	with Package(mainPackageName, packagesDir, version=version, section="java", homepage="https://github.com/oracle/graal/releases", provides=genGraalProvides(), descriptionShort="graalvm", descriptionLong="GraalVM is a high-performance, embeddable, polyglot virtual machine for running applications written in JavaScript, Python, Ruby, R, JVM-based languages like Java, Scala, Kotlin, and LLVM-based languages such as C and C++. \nAdditionally, GraalVM allows efficient interoperability between programming languages and compiling Java applications ahead-of-time into native executables for faster startup time and lower memory overhead.", maintainer=maintainer, builtDir=builtDir) as graalVM:
+	if only is not None:
+		return results
+
+	with Package(mainPackageName, packagesDir, arch=arch, version=version, section="java", homepage="https://github.com/oracle/graal/releases", provides=genGraalProvides(), descriptionShort="graalvm", descriptionLong="GraalVM is a high-performance, embeddable, polyglot virtual machine for running applications written in JavaScript, Python, Ruby, R, JVM-based languages like Java, Scala, Kotlin, and LLVM-based languages such as C and C++. \nAdditionally, GraalVM allows efficient interoperability between programming languages and compiling Java applications ahead-of-time into native executables for faster startup time and lower memory overhead.", maintainer=maintainer, builtDir=builtDir) as graalVM:
 		graalVM.rip(unpackedDir, systemPrefix)
 		results.append(graalVM)
 
@@ -185,8 +200,14 @@ def download(targets):
 	args = []
 
 	for dst, uri in targets.items():
+		if dst.exists() and not dst.with_name(dst.name + ".aria2").exists():  # complete, aria2c keeps a control file till the end
+			print("Already downloaded:", dst, file=sys.stderr)
+			continue
 		args += [uri, linesep, " ", "out=", str(dst), linesep]
 
+	if not args:
+		return
+
 	pO, pI = os.pipe()
 	with os.fdopen(pI, "w") as pIF:
 		pIF.write("".join(args))
@@ -202,63 +223,369 @@ def download(targets):
 
 vmTagRx = re.compile("^vm-((?:\\d+\\.){2}\\d+(?:-rc\\d+))?$")
 vmTitleMarker = "GraalVM Community Edition .+$"
-platformMarker = "linux-amd64"
+
+graalPlatforms = OrderedDict((
+	("amd64", "linux-amd64"),
+	("arm64", "linux-aarch64"),
+))  # Debian arch -> GraalVM platform
+
+qemuArchs = {
+	"amd64": "x86_64",
+	"arm64": "aarch64",
+}  # Debian arch -> qemu-user arch, also the arch `uname -m` reports
+
+binfmtMiscDir = Path("/proc/sys/fs/binfmt_misc")
+
+platformMarker = graalPlatforms["amd64"]
 versionFileNameMarker = "[\\w\\.-]+"
-releaseFileNameMarker = versionFileNameMarker + "-" + platformMarker
 
+graalRepo = "oracle/graal"
+runtimesRepos = {"python": "graalvm/graalpython", "ruby": "oracle/truffleruby", "R": "oracle/fastr"}
+
+
+def getReleaseFileNameMarker(platform=platformMarker):
+	return versionFileNameMarker + "-" + re.escape(platform)
+
+
+def canRunArch(arch):
+	"""Whether the binaries for the arch can be run on this host: natively or via qemu-user registered in binfmt_misc"""
+	qemuArch = qemuArchs[arch]
+	if os.uname().machine == qemuArch:
+		return True
+	handler = binfmtMiscDir / ("qemu-" + qemuArch)
+	return handler.is_file() and handler.read_text().startswith("enabled")
+
+
+def getGraalVMReleases(platform=platformMarker, targetsSource=getTargets):
+	downloadFileNameRx = re.compile("^" + getReleaseFileNameMarker(platform) + "\\.tar\\.gz$")
+	return list(targetsSource(graalRepo, re.compile("^" + vmTitleMarker), vmTagRx, downloadFileNameRx))
+
+
+def getGraalRuntimeReleases(repoPath, platform=platformMarker, targetsSource=getTargets):
+	downloadFileNameRx = re.compile(".+installable-ce-" + getReleaseFileNameMarker(platform) + "\\.jar$")
+	return list(targetsSource(repoPath, re.compile(".+- " + vmTitleMarker), vmTagRx, downloadFileNameRx))
+
+
+def selectNewestVersions(targets, count=1):
+	"""Returns the newest target for each of `count` newest versions, newest first"""
+	newest = {}
+	for t in targets:
+		if t.version not in newest or newest[t.version] < t:
+			newest[t.version] = t
+	return sorted(newest.values(), reverse=True)[:count]
+
+
+def selectRuntimeRelease(targets, version):
+	"""Returns the newest runtime target built for the GraalVM version or None"""
+	matching = [t for t in targets if t.version == version]
+	if matching:
+		return max(matching)
+	return None
+
+
+def getTargetStamp(target):
+	return target.fileModified.strftime("%Y%m%d%H%M%S")
+
+
+def getDownloadPath(downloadDir, target):
+	"""Downloads are keyed on the asset URI and its modification time, so a re-uploaded asset is fetched again"""
+	return downloadDir / (getTargetStamp(target) + "_" + Path(urlparse(target.uri).path).name)
+
+
+def isSameTarget(a, b):
+	return a is not None and b is not None and a.uri == b.uri and a == b
+
+
+class MatrixEntry:
+	"""A single (GraalVM version, architecture) cell of a build matrix.
+	If `only` is set to a collection of keys of `runtimes`, only packages of these runtimes are rebuilt."""
+
+	__slots__ = ("arch", "graal", "runtimes", "only")
+
+	def __init__(self, arch, graal, runtimes, only=None):
+		self.arch = arch
+		self.graal = graal
+		self.runtimes = runtimes
+		self.only = only
+
+	@property
+	def version(self):
+		return self.graal.version
+
+	@property
+	def name(self):
+		return self.version + "_" + self.arch
+
+	@property
+	def components(self):
+		"""Maps each component of the entry to its selected target"""
+		return OrderedDict(chain(((mainPackageName, self.graal),), self.runtimes.items()))
+
+	@property
+	def neededRuntimes(self):
+		if self.only is None:
+			return self.runtimes
+		return OrderedDict((k, v) for k, v in self.runtimes.items() if k in self.only)
+
+	@property
+	def targets(self):
+		"""Targets to be downloaded in order to build the entry"""
+		return list(chain((self.graal,), self.neededRuntimes.values()))
 
-def getLatestGraalVMRelease():
-	downloadFileNameRx = re.compile("^" + releaseFileNameMarker + "\\.tar\\.gz$")
-	return max(getTargets("oracle/graal", re.compile("^" + vmTitleMarker), vmTagRx, downloadFileNameRx))
+	@property
+	def packagesConfigKeys(self):
+		if self.only is None:
+			return None
+		return {k.lower() for k in self.only}
 
+	@property
+	def packagesVersion(self):
+		# reprepro refuses other contents under the same version, and a re-uploaded asset must not go below an already published version, so the version grows with the newest of all the selected assets
+		return self.version + "+" + getTargetStamp(max(self.components.values(), key=lambda t: t.fileModified))
 
-def getLatestGraalRuntimeRelease(repoPath):
-	downloadFileNameRx = re.compile(".+installable-ce-" + releaseFileNameMarker + "\\.jar$")
-	return max(getTargets(repoPath, re.compile(".+- " + vmTitleMarker), vmTagRx, downloadFileNameRx))
+	def __str__(self):
+		return self.name + ": " + str(self.graal) + "; runtimes: " + ", ".join(k + " " + str(v) for k, v in self.runtimes.items()) + ("; only " + ", ".join(self.only) if self.only is not None else "")
 
+	def __repr__(self):
+		return str(self)
 
-def doBuild():
+
+def getBuildMatrix(versions=1, archs=("amd64",), targetsSource=getTargets):
+	"""Selects releases of GraalVM and its runtimes for each of `versions` newest versions and each of the archs. The runtimes must be released for exactly the same GraalVM version, since `gu` refuses to install the other ones."""
+	matrix = []
+	for arch in archs:
+		platform = graalPlatforms[arch]
+		runtimesReleases = {k: getGraalRuntimeReleases(v, platform, targetsSource) for k, v in runtimesRepos.items()}
+		graalReleases = selectNewestVersions(getGraalVMReleases(platform, targetsSource), versions)
+		if not graalReleases:
+			raise Exception("No GraalVM release for " + platform + " has been found in " + graalRepo)
+		for selT in graalReleases:
+			runtimes = OrderedDict()
+			for k, releases in runtimesReleases.items():
+				rt = selectRuntimeRelease(releases, selT.version)
+				if rt is None:
+					raise Exception("No " + k + " runtime for GraalVM " + selT.version + " " + platform + " has been released yet")
+				runtimes[k] = rt
+			matrix.append(MatrixEntry(arch, selT, runtimes))
+	return matrix
+
+
+buildScripts = (Path(__file__), Path(pydebhelper.__file__))
+builtListFileName = "built.list"
+
+
+def getBuildInputsKey(entry):
+	"""A digest of everything the packages of an entry are built from: the selected assets, the packages config and the code ripping and building them"""
+	h = sha256()
+	components = [(k, t.uri, t.fileModified.isoformat()) for k, t in entry.components.items()]
+	h.update(repr((entry.arch, sorted(entry.only) if entry.only is not None else None, components, config)).encode("utf-8"))
+	for f in buildScripts:
+		h.update(f.read_bytes())
+	return h.hexdigest()[:16]
+
+
+def getEntryBuiltDir(builtDir, entry):
+	return builtDir / (entry.name + "_" + getBuildInputsKey(entry))
+
+
+def pruneCache(cacheDir, keep):
+	"""Removes everything from a cache dir except the paths in `keep`"""
+	if not cacheDir.is_dir():
+		return
+	keep = {p.name for p in keep}
+	for p in cacheDir.iterdir():
+		if p.name in keep:
+			continue
+		if p.is_dir() and not p.is_symlink():
+			shutil.rmtree(str(p))
+		else:
+			p.unlink()
+
+
+def buildMatrixEntry(entry, thisDir, maintainer):
+	"""Builds packages for a matrix entry from the already downloaded files, returns paths to the built packages. Meant to be run in a worker process."""
+	downloadDir = thisDir / "downloads"
+	unpackDir = thisDir / "graalvm-unpacked" / entry.name
+	packagesRootsDir = thisDir / "packagesRoots" / entry.name
+	builtDir = getEntryBuiltDir(thisDir / "packages", entry)
+	builtListPath = builtDir / builtListFileName
+
+	if builtListPath.is_file():
+		print("Already built:", entry.name, file=sys.stderr)
+		return [(builtDir / n).resolve() for n in builtListPath.read_text().splitlines()]
+
+	for d in (unpackDir, packagesRootsDir, builtDir):  # builtDir without the list is left by an interrupted build
+		if d.exists():
+			shutil.rmtree(str(d))
+
+	unpack(getDownloadPath(downloadDir, entry.graal), unpackDir)
+	graalUnpackedRoot = unpackDir / ("graalvm-ce-" + entry.version)
+
+	runtimes = entry.neededRuntimes
+	if runtimes:
+		guCmd = fj.bake(str(graalUnpackedRoot / "bin/gu"), _fg=True)
+		guCmd("-L", "install", *(str(getDownloadPath(downloadDir, v)) for v in runtimes.values()))
+
+	builtDir.mkdir(parents=True, exist_ok=True)
+
+	pkgs = ripGraalPackage(graalUnpackedRoot, packagesRootsDir, entry.packagesVersion, maintainer=maintainer, builtDir=builtDir, arch=entry.arch, only=entry.packagesConfigKeys)
+
+	for pkg in pkgs:
+		pkg.build()
+
+	debs = [pkg.debPath for pkg in pkgs]
+	builtListPath.write_text("".join(d.name + linesep for d in debs))
+
+	for d in (unpackDir, packagesRootsDir):  # a full GraalVM tree each, not needed once the .debs exist
+		shutil.rmtree(str(d))
+
+	return debs
+
+
+defaultComponent = "contrib"
+
+
+def getVersionsNewestFirst(matrix):
+	return [t.version for t in selectNewestVersions((entry.graal for entry in matrix), None)]
+
+
+def getVersionsComponents(versions):
+	"""Maps GraalVM versions, newest first, to repo components. reprepro keeps a single version of a package in a component, so the newest version goes into the default component and each older one into its own, which users can pin."""
+	return OrderedDict((v, (defaultComponent if i == 0 else mainPackageName + "-" + v)) for i, v in enumerate(versions))
+
+
+def pruneCaches(thisDir, matrix, keepBuilt):
+	"""Removes from the caches the downloads not needed by the (full) `matrix`, the built packages dirs not in `keepBuilt` and whatever is left unpacked"""
+	pruneCache(thisDir / "downloads", [getDownloadPath(thisDir / "downloads", t) for entry in matrix for t in entry.targets])
+	pruneCache(thisDir / "packages", keepBuilt)
+	pruneCache(thisDir / "graalvm-unpacked", ())
+	pruneCache(thisDir / "packagesRoots", ())
+
+
+def buildAndPublish(matrix, jobs=None, publishedVersions=None, publishedArchs=None):
+	"""Downloads everything needed, builds the matrix entries in worker processes and publishes the results into the repo. `publishedVersions` (newest first) and `publishedArchs` are the ones the whole repo has, if only a part of it is rebuilt. Versions absent from `publishedVersions` are removed from the repo. Returns the lists of the built packages of the entries."""
 	thisDir = Path(".")
 
 	downloadDir = Path(thisDir / "downloads")
-	archPath = Path(downloadDir / "graalvm-github.tar.gz")
-	unpackDir = thisDir / "graalvm-unpacked"
-	packagesRootsDir = thisDir / "packagesRoots"
 	builtDir = thisDir / "packages"
 	repoDir = thisDir / "public" / "repo"
 
-	selT = getLatestGraalVMRelease()
+	for entry in matrix:
+		print("Selected release:", entry, file=sys.stderr)
 
-	print("Selected release:", selT, file=sys.stderr)
+	if publishedVersions is None:
+		publishedVersions = getVersionsNewestFirst(matrix)
 
-	runtimesRepos = {"python": "graalvm/graalpython", "ruby": "oracle/truffleruby", "R": "oracle/fastr"}
+	if publishedArchs is None:
+		publishedArchs = {entry.arch for entry in matrix}
 
-	runtimeReleases = {k: getLatestGraalRuntimeRelease(v) for k, v in runtimesRepos.items()}
+	versionsComponents = getVersionsComponents(publishedVersions)
+	components = (defaultComponent, "non-free") + tuple(versionsComponents.values())[1:]
 
-	runtimeFiles = {(downloadDir / (k + ".jar")): v.uri for k, v in runtimeReleases.items()}
+	for arch in {entry.arch for entry in matrix if entry.neededRuntimes}:
+		if not canRunArch(arch):
+			raise Exception("Installing the runtimes runs `gu` of GraalVM for " + arch + ", but this host can run neither " + arch + " binaries natively nor via qemu-user-static registered in binfmt_misc (" + str(binfmtMiscDir / ("qemu-" + qemuArchs[arch])) + ")")
 
-	downloadTargets = {archPath: selT.uri, **runtimeFiles}
+	downloadDir.mkdir(parents=True, exist_ok=True)
+	downloadTargets = {}
+	for entry in matrix:
+		for t in entry.targets:
+			downloadTargets[getDownloadPath(downloadDir, t)] = t.uri
 
 	download(downloadTargets)
-	unpack(archPath, unpackDir)
-	graalUnpackedRoot = unpackDir / ("graalvm-ce-" + selT.version)
-
-	guCmd = fj.bake(str(graalUnpackedRoot / "bin/gu"), _fg=True)
-	guCmd("-L", "install", *runtimeFiles.keys())
-
 	builtDir.mkdir(parents=True, exist_ok=True)
 
 	maintainer = Maintainer()
-	pkgs = ripGraalPackage(graalUnpackedRoot, packagesRootsDir, selT.version, maintainer=maintainer, builtDir=builtDir)
 
-	for pkg in pkgs:
-		pkg.build()
+	if len(matrix) == 1 or jobs == 1:
+		debs = [buildMatrixEntry(entry, thisDir, maintainer) for entry in matrix]
+	else:
+		with ProcessPoolExecutor(max_workers=jobs) as pool:
+			debs = list(pool.map(buildMatrixEntry, matrix, repeat(thisDir), repeat(maintainer)))
 
-	with Repo(root=repoDir, descr=maintainer.name+"'s repo for apt with GraalVM binary packages, built from the official builds on GitHub") as r:
-		for pkg in pkgs:
-			r += pkg
+	with Repo(root=repoDir, descr=maintainer.name+"'s repo for apt with GraalVM binary packages, built from the official builds on GitHub", archs=sorted(publishedArchs), components=components) as r:
+		for entry, entryDebs in zip(matrix, debs):
+			for deb in entryDebs:
+				r.add(deb, versionsComponents[entry.version])
 		print(r.packages2add)
 
+	return debs
+
+
+def doBuild(versions=1, archs=("amd64",), jobs=None):
+	matrix = getBuildMatrix(versions, archs)
+	debs = buildAndPublish(matrix, jobs)
+	pruneCaches(Path("."), matrix, [entryDebs[0].parent for entryDebs in debs])
+
+
+def getChangedEntries(matrix, published, versionsComponents, publishedComponents):
+	"""Returns the entries of the matrix having components with selected targets differing from the `published` ones, restricted to these components. `published` maps (entry name, component) to a target. An entry to be moved into another repo component (`publishedComponents` maps entry names to them) is returned whole."""
+	res = []
+	for entry in matrix:
+		if publishedComponents.get(entry.name, None) != versionsComponents[entry.version]:
+			res.append(entry)
+			continue
+		changed = [k for k, t in entry.components.items() if not isSameTarget(published.get((entry.name, k), None), t)]
+		if not changed:
+			continue
+		if mainPackageName in changed:
+			res.append(entry)
+		else:
+			res.append(MatrixEntry(entry.arch, entry.graal, entry.runtimes, only=changed))
+	return res
+
+
+def doWatch(versions=1, archs=("amd64",), jobs=None, interval=600.):
+	"""Polls the upstream releases and rebuilds only the components whose selected releases have changed. Never returns."""
+	poller = ReleasesPoller(chain((graalRepo,), runtimesRepos.values()))
+	published = {}
+	publishedComponents = {}
+	builtDirs = {}  # (entry name, component) -> dir with its last built package
+
+	while True:
+		try:
+			changedRepos = poller.poll()
+		except Exception as ex:
+			warnings.warn("Polling has failed, the changes found so far are kept till the next poll: " + repr(ex))
+		else:
+			if changedRepos:
+				print("Changed:", ", ".join(sorted(changedRepos)), file=sys.stderr)
+				try:
+					matrix = getBuildMatrix(versions, archs, poller.getTargets)
+					publishedVersions = getVersionsNewestFirst(matrix)
+					versionsComponents = getVersionsComponents(publishedVersions)
+					changedEntries = getChangedEntries(matrix, published, versionsComponents, publishedComponents)
+					if changedEntries:
+						debs = buildAndPublish(changedEntries, jobs, publishedVersions, {entry.arch for entry in matrix})
+						for entry, entryDebs in zip(changedEntries, debs):
+							for k in (entry.components if entry.only is None else entry.only):
+								builtDirs[entry.name, k] = entryDebs[0].parent
+				except Exception as ex:
+					warnings.warn("Build has failed, will retry on the next poll: " + repr(ex))
+				else:
+					published = {(entry.name, k): t for entry in matrix for k, t in entry.components.items()}
+					publishedComponents = {entry.name: versionsComponents[entry.version] for entry in matrix}
+					builtDirs = {k: d for k, d in builtDirs.items() if k in published}  # entries out of the matrix are removed from the repo
+					pruneCaches(Path("."), matrix, set(builtDirs.values()))
+					poller.done(changedRepos)
+
+		time.sleep(max(interval, poller.getInterval()))
+
+
+def main():
+	argP = argparse.ArgumentParser(description="Builds Debian packages of GraalVM and publishes them into an apt repo")
+	argP.add_argument("--versions", type=int, default=1, help="Count of the newest GraalVM versions to build")
+	argP.add_argument("--arch", action="append", choices=tuple(graalPlatforms), dest="archs", help="Debian architecture to build for, can be repeated. amd64 by default.")
+	argP.add_argument("-j", "--jobs", type=int, default=None, help="Count of worker processes building matrix entries in parallel")
+	argP.add_argument("--watch", action="store_true", help="Keep running, polling the upstream releases and rebuilding the changed components")
+	argP.add_argument("--interval", type=float, default=600., help="Minimal interval between polls in watch mode, in seconds. Made longer if needed to fit into the GitHub API rate limit.")
+	args = argP.parse_args()
+	archs = args.archs or ("amd64",)
+	if args.watch:
+		doWatch(versions=args.versions, archs=archs, jobs=args.jobs, interval=args.interval)
+	else:
+		doBuild(versions=args.versions, archs=archs, jobs=args.jobs)
+
 
 if __name__ == "__main__":
-	doBuild()
+	main()
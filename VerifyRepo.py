@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import tarfile
+import hashlib
+import lzma
+import gzip
+import bz2
+import argparse
+from pathlib import Path
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+chunkSize = 1 << 20
+
+indexCompressions = OrderedDict((
+	("", open),
+	(".xz", lzma.open),
+	(".gz", gzip.open),
+	(".bz2", bz2.open),
+))
+
+indexHashFields = OrderedDict((
+	("MD5sum", "md5"),
+	("MD5Sum", "md5"),
+	("SHA1", "sha1"),
+	("SHA256", "sha256"),
+	("SHA512", "sha512"),
+))
+
+archiveErrors = (OSError, EOFError, ValueError, tarfile.TarError, lzma.LZMAError)
+
+
+class VerificationResult:
+	__slots__ = ("kind", "path", "size", "failures", "skipped")
+
+	def __init__(self, kind, path, size=0, failures=None, skipped=False):
+		self.kind = kind
+		self.path = path
+		self.size = size
+		self.failures = failures if failures is not None else []
+		self.skipped = skipped
+
+	@property
+	def ok(self):
+		return not self.failures
+
+	def __str__(self):
+		return self.kind + " " + str(self.path) + ": " + ("skipped" if self.skipped else ("OK" if self.ok else "; ".join(self.failures)))
+
+
+class ArMemberReader:
+	"""A file-like object reading a single member of an ar archive without copying it anywhere"""
+
+	__slots__ = ("f", "left")
+
+	def __init__(self, f, size):
+		self.f = f
+		self.left = size
+
+	def read(self, n=-1):
+		if n is None or n < 0 or n > self.left:
+			n = self.left
+		res = self.f.read(n)
+		self.left -= len(res)
+		return res
+
+	def skip(self):
+		self.f.seek(self.left, os.SEEK_CUR)
+		self.left = 0
+
+
+class HashingReader:
+	"""A file-like object hashing everything read through it. Seeking forward reads the skipped bytes, so they are hashed too."""
+
+	__slots__ = ("f", "HObjs", "size")
+
+	def __init__(self, f, hashNames):
+		self.f = f
+		self.HObjs = [hashlib.new(n) for n in hashNames]
+		self.size = 0
+
+	def read(self, n=-1):
+		res = self.f.read(n)
+		self.size += len(res)
+		for h in self.HObjs:
+			h.update(res)
+		return res
+
+	def seek(self, offset, whence=os.SEEK_CUR):
+		if whence != os.SEEK_CUR or offset < 0:
+			raise ValueError("Only seeking forward is supported")
+		while offset:
+			chunk = self.read(min(offset, chunkSize))
+			if not chunk:
+				break
+			offset -= len(chunk)
+
+	def drain(self):
+		while self.read(chunkSize):
+			pass
+
+	def hexdigests(self):
+		return {h.name: h.hexdigest() for h in self.HObjs}
+
+
+def iterArMembers(f):
+	"""Yields (name, reader) for each member of an ar archive (the container of .deb)"""
+	if f.read(8) != b"!<arch>\n":
+		raise ValueError("Not an ar archive")
+
+	while True:
+		hdr = f.read(60)
+		if not hdr:
+			return
+		if len(hdr) != 60 or hdr[58:60] != b"`\n":
+			raise ValueError("Broken ar member header")
+
+		name = hdr[:16].decode("ascii").strip().rstrip("/")
+		size = int(hdr[48:58])
+		m = ArMemberReader(f, size)
+		yield name, m
+		m.skip()
+		if size % 2:
+			f.read(1)
+
+
+def normTarPath(p):
+	while p.startswith("./"):
+		p = p[2:]
+	return p.lstrip("/")
+
+
+def hashStream(f, hashNames):
+	"""Returns (size, {hashName: hexdigest}) of a stream"""
+	HObjs = [hashlib.new(n) for n in hashNames]
+	size = 0
+	while True:
+		chunk = f.read(chunkSize)
+		if not chunk:
+			break
+		size += len(chunk)
+		for h in HObjs:
+			h.update(chunk)
+	return size, {n: h.hexdigest() for n, h in zip(hashNames, HObjs)}
+
+
+def parseSums(text):
+	"""Parses a `*sums` file into a dict path -> hexdigest"""
+	res = {}
+	for l in text.splitlines():
+		if not l.strip():
+			continue
+		h, p = l.split(None, 1)
+		res[normTarPath(p.strip())] = h.lower()
+	return res
+
+
+def parseDeb822(text):
+	"""Parses a deb822 control text (`Packages`, `Release`) into a list of stanzas. Values of multi-line fields keep their lines separated with newlines."""
+	stanzas = []
+	cur = OrderedDict()
+	k = None
+	for l in text.splitlines():
+		if not l.strip():
+			if cur:
+				stanzas.append(cur)
+			cur = OrderedDict()
+			k = None
+		elif l[0] in " \t":
+			if k is not None:
+				cur[k] += "\n" + l.strip()
+		else:
+			k, v = l.split(":", 1)
+			cur[k] = v.strip()
+	if cur:
+		stanzas.append(cur)
+	return stanzas
+
+
+def checkDebPayload(f, failures):
+	"""Checks the data payload of a .deb read from `f` against the `*sums` files from its control archive, streaming both. Appends the found problems to `failures`, returns the count of payload bytes hashed."""
+	sums = {}
+	seen = set()
+	size = 0
+	hasData = False
+	try:
+		for name, m in iterArMembers(f):
+			if name.startswith("control.tar"):
+				with tarfile.open(fileobj=m, mode="r|*") as t:
+					for ti in t:
+						n = normTarPath(ti.name)
+						if ti.isfile() and n.endswith("sums") and n[:-4] in hashlib.algorithms_available:
+							sums[n[:-4]] = parseSums(t.extractfile(ti).read().decode("utf-8"))
+			elif name.startswith("data.tar"):
+				hasData = True
+				if not sums:
+					failures.append("no *sums files in the control archive")
+					break
+				hashNames = tuple(sums)
+				hashed = {}  # path -> digests of the regular files seen so far, hard links refer to them
+				with tarfile.open(fileobj=m, mode="r|*") as t:
+					for ti in t:
+						n = normTarPath(ti.name)
+						if ti.isfile():
+							fSize, actual = hashStream(t.extractfile(ti), hashNames)
+							size += fSize
+							hashed[n] = actual
+						elif ti.islnk():
+							actual = hashed.get(normTarPath(ti.linkname), None)
+						else:
+							continue
+
+						expected = {hn: s[n] for hn, s in sums.items() if n in s}
+						if not expected:
+							continue
+						seen.add(n)
+						if actual is None:
+							failures.append(n + ": hard link to " + ti.linkname + ", which is not a preceding regular file")
+							continue
+						for hn, h in expected.items():
+							if actual[hn] != h:
+								failures.append(n + ": " + hn + " mismatch")
+	except archiveErrors as ex:
+		failures.append("broken archive: " + repr(ex))
+	else:
+		if not hasData:
+			failures.append("no data archive")
+		missing = set().union(*sums.values()) - seen
+		failures.extend(sorted(n + ": listed in sums, but missing in the data archive" for n in missing))
+	return size
+
+
+def verifyDeb(path, indexEntries=()):
+	"""Checks a .deb: its data payload against its own `*sums` and, if `indexEntries` (pairs of size and hashes from `Packages`) are given, the whole file against them. The file is hashed while being parsed, so it is read only once."""
+	if not path.is_file():
+		return VerificationResult("deb", path, failures=["missing"])
+
+	failures = []
+	hashNames = tuple(sorted(set().union(*(h for s, h in indexEntries))))
+	try:
+		with path.open("rb") as rawF:
+			f = HashingReader(rawF, hashNames) if indexEntries else rawF
+			size = checkDebPayload(f, failures)
+			if indexEntries:
+				f.drain()
+	except OSError as ex:
+		return VerificationResult("deb", path, failures=failures + [repr(ex)])
+
+	if indexEntries:
+		size += f.size
+		actual = f.hexdigests()
+		for expectedSize, expectedHashes in indexEntries:
+			if expectedSize is not None and f.size != expectedSize:
+				failures.append("size " + str(f.size) + " != " + str(expectedSize) + " in Packages")
+			for hn, h in expectedHashes.items():
+				if actual[hn] != h:
+					failures.append(hn + " mismatch with Packages")
+	return VerificationResult("deb", path, size, failures)
+
+
+def verifyFile(kind, path, expectedSize, expectedHashes, optional=False):
+	"""Checks size and hashes of a file referred from an index"""
+	if not path.is_file():
+		if optional:
+			return VerificationResult(kind, path, skipped=True)
+		return VerificationResult(kind, path, failures=["missing"])
+
+	failures = []
+	try:
+		with path.open("rb") as f:
+			size, actual = hashStream(f, tuple(expectedHashes))
+	except OSError as ex:
+		return VerificationResult(kind, path, failures=[repr(ex)])
+
+	if expectedSize is not None and size != expectedSize:
+		failures.append("size " + str(size) + " != " + str(expectedSize))
+	for hn, h in expectedHashes.items():
+		if actual[hn] != h:
+			failures.append(hn + " mismatch")
+	return VerificationResult(kind, path, size, failures)
+
+
+def uniqueDirs(dirs):
+	res = OrderedDict()
+	for d in dirs:
+		res.setdefault(d.resolve(), d)
+	return list(res.values())
+
+
+def readIndex(basePath):
+	"""Reads an index file, taking whichever of its compressed variants exists"""
+	for ext, opener in indexCompressions.items():
+		p = basePath.parent / (basePath.name + ext)
+		if p.is_file():
+			with opener(p, "rt", encoding="utf-8") as f:
+				return f.read()
+	return None
+
+
+def getReleaseChecks(releaseDir, release):
+	"""Returns (path, size, hashes) for each file listed in a `Release`"""
+	expected = OrderedDict()
+	for field, hn in indexHashFields.items():
+		for l in release.get(field, "").splitlines():
+			if not l.strip():
+				continue
+			h, s, p = l.split()
+			size, hashes = expected.setdefault(p, (int(s), {}))
+			hashes[hn] = h.lower()
+	return [(releaseDir / p, s, h) for p, (s, h) in expected.items()]
+
+
+def getPackagesChecks(repoRoot, packagesText):
+	"""Returns (path, size, hashes) for each pool file listed in a `Packages`"""
+	res = []
+	for st in parseDeb822(packagesText):
+		hashes = {hn: st[f].lower() for f, hn in indexHashFields.items() if f in st}
+		res.append((repoRoot / st["Filename"], int(st["Size"]) if "Size" in st else None, hashes))
+	return res
+
+
+def collectChecks(repoRoot):
+	"""Returns a list of (function, args) for all the checks of a repo and a list of failures found while collecting them"""
+	checks = []
+	failures = []
+	releaseChecks = OrderedDict()
+	packagesChecks = OrderedDict()
+
+	distsDirs = uniqueDirs(p for p in sorted((repoRoot / "dists").glob("*")) if p.is_dir())
+	for d in distsDirs:
+		releaseText = readIndex(d / "Release")
+		if releaseText is None:
+			failures.append(str(d) + ": no Release")
+			continue
+		for st in parseDeb822(releaseText):
+			for p, s, h in getReleaseChecks(d, st):
+				releaseChecks.setdefault((p.resolve(), s, tuple(sorted(h.items()))), (p, s, h))
+
+		for packagesBase in sorted(set(p.parent / p.name.split(".")[0] for p in d.glob("*/binary-*/Packages*"))):
+			packagesText = readIndex(packagesBase)
+			if packagesText is None:
+				continue
+			for p, s, h in getPackagesChecks(repoRoot, packagesText):
+				packagesChecks.setdefault((p.resolve(), s, tuple(sorted(h.items()))), (p, s, h))
+
+	if not distsDirs:
+		failures.append(str(repoRoot / "dists") + ": no distributions")
+
+	for p, s, h in releaseChecks.values():
+		checks.append((verifyFile, ("index", p, s, h, True)))
+	debsIndexEntries = OrderedDict()
+	for p, s, h in packagesChecks.values():
+		if p.suffix == ".deb":
+			debsIndexEntries.setdefault(p.resolve(), (p, []))[1].append((s, h))
+		else:
+			checks.append((verifyFile, ("pool", p, s, h)))
+	for p in sorted((repoRoot / "pool").glob("**/*.deb")):
+		debsIndexEntries.setdefault(p.resolve(), (p, []))
+	for p, indexEntries in debsIndexEntries.values():
+		checks.append((verifyDeb, (p, indexEntries)))
+
+	return checks, failures
+
+
+def runCheck(func, args):
+	return func(*args)
+
+
+def verifyRepo(repoRoot, jobs=None, stream=sys.stdout):
+	"""Verifies the repo in parallel, prints per-file failures and throughput. Returns True if everything is OK."""
+	beginTime = time.monotonic()
+	checks, failures = collectChecks(repoRoot)
+	for f in failures:
+		print("FAIL", f, file=stream)
+
+	stats = defaultdict(lambda: [0, 0, 0, 0])  # count, failed, skipped, bytes
+	with ProcessPoolExecutor(max_workers=jobs) as pool:
+		futures = [pool.submit(runCheck, func, args) for func, args in checks]
+		for fut in as_completed(futures):
+			r = fut.result()
+			st = stats[r.kind]
+			st[0] += 1
+			st[3] += r.size
+			if r.skipped:
+				st[2] += 1
+			elif not r.ok:
+				st[1] += 1
+				for f in r.failures:
+					print("FAIL", r.kind, str(r.path) + ":", f, file=stream)
+
+	elapsed = time.monotonic() - beginTime
+	totalSize = 0
+	totalFailed = len(failures)
+	for kind, (count, failed, skipped, size) in stats.items():
+		totalSize += size
+		totalFailed += failed
+		print(kind + ":", count, "files,", failed, "failed,", skipped, "skipped,", "{:.1f}".format(size / 2**20), "MiB", file=stream)
+	print("verified", "{:.1f}".format(totalSize / 2**20), "MiB in", "{:.2f}".format(elapsed), "s,", "{:.1f}".format(totalSize / 2**20 / elapsed if elapsed else 0.), "MiB/s", file=stream)
+	return not totalFailed
+
+
+def main():
+	argP = argparse.ArgumentParser(description="Verifies the .debs, the Packages and the Release indices of a published apt repo")
+	argP.add_argument("repo", type=Path, nargs="?", default=Path("public") / "repo", help="Root of the repo")
+	argP.add_argument("-j", "--jobs", type=int, default=None, help="Count of worker processes")
+	args = argP.parse_args()
+	if not verifyRepo(args.repo, jobs=args.jobs):
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import sys
+import os
 from datetime import datetime
 from dateutil.parser import parse as parseDT
 import requests
@@ -37,24 +38,26 @@ class DownloadTarget:
 		return self.cmpTuple() == other.cmpTuple()
 
 
-def getTargets(repoPath, titleRx, tagRx, downloadFileNameRx):
-	RELEASES_EP = GH_API_BASE + "repos/" + repoPath + "/releases"
-
-	req = requests.get(RELEASES_EP)
-	headers = requests.utils.default_headers()
-	headers["User-Agent"] = "LatestReleaseRetriever"
-	h = req.headers
+def getRateLimit(h):
+	"""Returns (remaining, total, reset time) from headers of a GitHub API response"""
 	limitRemaining = int(h["X-RateLimit-Remaining"])
 	limitTotal = int(h["X-RateLimit-Limit"])
 	limitResetTime = datetime.datetime.utcfromtimestamp(int(h["X-RateLimit-Reset"]))
+	return limitRemaining, limitTotal, limitResetTime
 
-	print(limitRemaining, "/", limitTotal, str((limitRemaining / limitTotal)*100.)+"%", "limit will be reset:", limitResetTime, "in", limitResetTime - datetime.datetime.now())
 
-	t = req.json()
+def printRateLimit(limitRemaining, limitTotal, limitResetTime):
+	print(limitRemaining, "/", limitTotal, str((limitRemaining / limitTotal)*100.)+"%", "limit will be reset:", limitResetTime, "in", limitResetTime - datetime.datetime.utcnow())
 
+
+def checkReleasesResponse(t):
 	if isinstance(t, dict) and "message" in t:
 		raise Exception(t["message"])
+	return t
+
 
+def parseTargets(t, titleRx, tagRx, downloadFileNameRx):
+	"""Yields `DownloadTarget`s from a parsed GitHub API releases list"""
 	for r in t:
 		nm = r["name"]
 		if not titleRx.match(nm):
@@ -74,3 +77,85 @@ def getTargets(repoPath, titleRx, tagRx, downloadFileNameRx):
 			fc = parseDT(a["created_at"])
 			m = parseDT(a["updated_at"])
 			yield DownloadTarget(nm, v, pr, c, p, fc, m, a["browser_download_url"])
+
+
+def getTargets(repoPath, titleRx, tagRx, downloadFileNameRx):
+	RELEASES_EP = GH_API_BASE + "repos/" + repoPath + "/releases"
+
+	req = requests.get(RELEASES_EP)
+	headers = requests.utils.default_headers()
+	headers["User-Agent"] = "LatestReleaseRetriever"
+	printRateLimit(*getRateLimit(req.headers))
+
+	t = checkReleasesResponse(req.json())
+
+	yield from parseTargets(t, titleRx, tagRx, downloadFileNameRx)
+
+
+class ReleasesPoller:
+	"""Keeps the releases lists of GitHub repos warm and refreshes them with conditional requests, which don't consume the rate limit when nothing has changed.
+	`getTargets` has the same signature as the module-level one, but uses the kept lists.
+	A detected change stays pending until it is acknowledged with `done`, so it is not lost when a later request or the processing of the change fails: the kept list is already updated, so the repo would answer 304 the next time."""
+
+	__slots__ = ("repos", "etags", "releases", "pending", "rateLimit", "session")
+
+	def __init__(self, repos):
+		self.repos = tuple(repos)
+		self.etags = {}
+		self.pending = set()
+		self.releases = {}
+		self.rateLimit = None
+		self.session = requests.Session()
+		self.session.headers["User-Agent"] = "LatestReleaseRetriever"
+		token = os.environ.get("GITHUB_TOKEN", None)
+		if token:
+			self.session.headers["Authorization"] = "token " + token
+
+	def fetch(self, repoPath):
+		"""Refreshes the releases list of a repo, returns True if it has changed. A changed repo is added to the pending ones."""
+		headers = {}
+		etag = self.etags.get(repoPath, None)
+		if etag is not None and repoPath in self.releases:
+			headers["If-None-Match"] = etag
+
+		req = self.session.get(GH_API_BASE + "repos/" + repoPath + "/releases", headers=headers)
+		self.rateLimit = getRateLimit(req.headers)
+
+		if req.status_code == 304:
+			return False
+
+		t = checkReleasesResponse(req.json())
+		req.raise_for_status()
+		self.etags[repoPath] = req.headers.get("ETag", None)
+		changed = self.releases.get(repoPath, None) != t
+		self.releases[repoPath] = t
+		if changed:
+			self.pending.add(repoPath)
+		return changed
+
+	def poll(self):
+		"""Refreshes all the repos, returns the set of the ones having changed since the last `done`"""
+		for r in self.repos:
+			self.fetch(r)
+		printRateLimit(*self.rateLimit)
+		return set(self.pending)
+
+	def done(self, repos):
+		"""Acknowledges that the changes of the repos have been processed"""
+		self.pending -= set(repos)
+
+	def getTargets(self, repoPath, titleRx, tagRx, downloadFileNameRx):
+		if repoPath not in self.releases:
+			self.fetch(repoPath)
+		return parseTargets(self.releases[repoPath], titleRx, tagRx, downloadFileNameRx)
+
+	def getInterval(self, minInterval=60.):
+		"""Returns the count of seconds to wait before the next poll so that polling at this pace doesn't exhaust the rate limit before it is reset"""
+		if self.rateLimit is None:
+			return minInterval
+		limitRemaining, limitTotal, limitResetTime = self.rateLimit
+		untilReset = max((limitResetTime - datetime.datetime.utcnow()).total_seconds(), 0.)
+		pollsLeft = limitRemaining // len(self.repos)
+		if not pollsLeft:
+			return max(untilReset, minInterval)
+		return max(untilReset / pollsLeft, minInterval)
@@ -1,8 +1,9 @@
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 from pathlib import Path
 from hashlib import md5, sha256, blake2b, sha3_512
 from os import readlink, linesep, fchdir
 import os
+import sys
 import mmap
 import warnings
 import sh
@@ -41,8 +42,8 @@ class Maintainer:
 		return str(self)
 
 
-def sumFile(path, hashers=(md5,)):
-	"""Creates an object with hashsums of a file"""
+def hashFile(path, hashers=(md5,)):
+	"""Feeds a file into fresh hash objects and returns them"""
 	HObjs = [h() for h in hashers]
 	if path.stat().st_size:
 		with path.open("rb") as f:
@@ -50,7 +51,89 @@ def sumFile(path, hashers=(md5,)):
 			with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as m:
 				for h in HObjs:
 					h.update(m)
-	return {h.name: h.hexdigest() for h in HObjs}
+	return HObjs
+
+
+def digestFile(path, hashers=(md5,)):
+	"""Returns a tuple of raw digests of a file, in the order of `hashers`"""
+	return tuple(h.digest() for h in hashFile(path, hashers))
+
+
+class DigestsStore:
+	"""A compact sorted store of file digests.
+	Each path is interned and stored once, digests of each hash function are packed into a single bytearray of fixed-width records, so the memory grows with the count of files, not with the count of files times the count of hash functions."""
+
+	__slots__ = ("names", "sizes", "paths", "digests")
+
+	def __init__(self, hashers=(md5,)):
+		hObjs = [h() for h in hashers]
+		self.names = tuple(h.name for h in hObjs)
+		self.sizes = tuple(h.digest_size for h in hObjs)
+		self.paths = []
+		self.digests = tuple(bytearray() for h in hObjs)
+
+	def __len__(self):
+		return len(self.paths)
+
+	def __bool__(self):
+		return bool(self.paths)
+
+	def _put(self, paths, digests, path, pathDigests):
+		"""Appends a record to (paths, digests), or replaces the last one if it is for the same path"""
+		if paths and paths[-1] == path:
+			for d, s, dig in zip(digests, self.sizes, pathDigests):
+				d[-s:] = dig
+			return
+
+		for s, dig in zip(self.sizes, pathDigests):
+			if len(dig) != s:
+				raise ValueError("Digest of " + path + " has wrong size: " + str(len(dig)) + " != " + str(s))
+		paths.append(sys.intern(path))
+		for d, dig in zip(digests, pathDigests):
+			d += dig
+
+	def _copy(self, paths, digests, i):
+		"""Appends the i-th stored record to (paths, digests)"""
+		paths.append(self.paths[i])
+		for dst, src, s in zip(digests, self.digests, self.sizes):
+			dst += src[i * s:(i + 1) * s]
+
+	def update(self, paths, getDigests):
+		"""Adds records for an iterable of paths. The paths are sorted and either appended (if they all go after the stored ones) or merged with the stored ones by index; `getDigests(path)` is called right before the record of a path is written. A later record for the same path replaces the former one.
+		A merge is built aside and replaces the stored records only when complete, so if `getDigests` raises, the store keeps its former contents."""
+		paths = sorted(paths)
+		if not paths:
+			return
+
+		if not self.paths or self.paths[-1] < paths[0]:
+			for p in paths:
+				self._put(self.paths, self.digests, p, getDigests(p))
+			return
+
+		newPaths = []
+		newDigests = tuple(bytearray() for d in self.digests)
+		i = 0
+		for p in paths:
+			while i < len(self.paths) and self.paths[i] < p:
+				self._copy(newPaths, newDigests, i)
+				i += 1
+			if i < len(self.paths) and self.paths[i] == p:
+				i += 1
+			self._put(newPaths, newDigests, p, getDigests(p))
+
+		for i in range(i, len(self.paths)):
+			self._copy(newPaths, newDigests, i)
+
+		self.paths = newPaths
+		self.digests = newDigests
+
+	def iterLines(self, hashName):
+		"""Yields lines of a `*sums` file for the hash function"""
+		hI = self.names.index(hashName)
+		d = self.digests[hI]
+		s = self.sizes[hI]
+		for i, p in enumerate(self.paths):
+			yield d[i * s:(i + 1) * s].hex() + "  " + p + linesep
 
 
 class Package:
@@ -68,7 +151,7 @@ class Package:
 		self.builtDir = builtDir
 
 	def __enter__(self):
-		self.hashsums = defaultdict(OrderedDict)
+		self.hashsums = DigestsStore(self.hashfuncs)
 		return self
 
 	def __exit__(self, *args, **kwargs):
@@ -111,12 +194,11 @@ class Package:
 		ctrlF.write_text(createControlText(**self.controlDict))
 
 	def createSums(self):
-		for hashName, hashes in self.hashsums.items():
-			hashes = type(hashes)(sorted(hashes.items(), key=lambda x: x[0]))
-			if hashes:
+		if self.hashsums:
+			for hashName in self.hashsums.names:
 				sumsF = self.debian / (hashName + "sums")
 				with sumsF.open("wt") as f:
-					f.writelines(v + "  " + k + linesep for k, v in hashes.items())
+					f.writelines(self.hashsums.iterLines(hashName))
 
 	def resolvePath(self, p: Path, recurseSymlinks=True) -> Path:
 		while p.is_symlink():
@@ -142,17 +224,14 @@ class Package:
 			src.rename(resPath)
 
 			if resPath.is_dir():
-				files = [f for f in resPath.glob("**/*") if (f.is_file() and not f.is_symlink())]
+				files = [str(f.relative_to(self.root)) for f in resPath.glob("**/*") if (f.is_file() and not f.is_symlink())]
 			else:
 				if not resPath.is_symlink():
-					files = [resPath]
+					files = [str(resPath.relative_to(self.root))]
 
 		# print(files)
 
-		for f in files:
-			hashes = sumFile(f, self.hashfuncs)
-			for hashFuncName, h in hashes.items():
-				self.hashsums[hashFuncName][str(f.relative_to(self.root))] = h
+		self.hashsums.update(files, lambda p: digestFile(self.root / p, self.hashfuncs))
 
 	@property
 	def debPath(self):
@@ -238,9 +317,10 @@ def createDistributionsText(descr, releases, components=("contrib", "non-free"),
 
 
 repreproCmd = sh.reprepro.bake(_fg=True)
-includeDebCmd = repreproCmd.includedeb
 exportCmd = repreproCmd.export
 createSymlinksCmd = repreproCmd.createsymlinks
+clearVanishedCmd = repreproCmd.clearvanished
+deleteUnreferencedCmd = repreproCmd.deleteunreferenced
 
 
 class Repo:
@@ -298,6 +378,10 @@ class Repo:
 	def codename(self):
 		return self.mainRelease.codename
 
+	@property
+	def components(self):
+		return self.distrsDict.get("components", ("contrib", "non-free"))
+
 	@property
 	def conf(self):
 		rootDir = self.root / "conf"
@@ -317,10 +401,16 @@ class Repo:
 
 		return self
 
-	def __iadd__(self, pkg: typing.Union[Package, Path]):
-		self.packages2add.append(pkg)
+	def add(self, pkg: typing.Union[Package, Path], component: str = None):
+		"""Schedules a package to be included into a component, the first one by default"""
+		if component is None:
+			component = self.components[0]
+		self.packages2add.append((pkg, component))
 		if isinstance(pkg, Package):
 			self.archs |= {pkg.arch}
+
+	def __iadd__(self, pkg: typing.Union[Package, Path]):
+		self.add(pkg)
 		return self
 
 	def generateRepo(self):
@@ -330,18 +420,20 @@ class Repo:
 		# try:
 		rootDescr = os.open(self.root, os.O_RDONLY)
 		fchdir(rootDescr)
+		clearVanishedCmd()  # drops the packages of the components and codenames no longer in `conf/distributions`
 		exportCmd()
 		createSymlinksCmd()
-		for pkg in self.packages2add:
+		for pkg, component in self.packages2add:
 			if isinstance(pkg, Path):
 				pkgPath = pkg
 			else:
 				pkgPath = pkg.debPath
-			print("adding", pkgPath)
+			print("adding", pkgPath, "to", component)
 			for r in self.releases:
 				for cn in r.codenames:
-					includeDebCmd(cn, pkgPath)
+					repreproCmd.bake(C=component).includedeb(cn, pkgPath)
 
+		deleteUnreferencedCmd()  # the files of the replaced and dropped packages
 		self.packages2add = []
 		# finally:
 		if rootDescr is not None: